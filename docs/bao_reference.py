@@ -4,9 +4,9 @@
 # as possible and generating test vectors. There are a few differences that
 # make this code much simpler than the Rust version:
 #
-# 1. This version's encode implementation buffers all input and output in
-#    memory. The Rust version uses a more complicated tree-flipping strategy to
-#    avoid using extra storage.
+# 1. This version's encode implementation buffers all input, and all parent
+#    nodes, in memory. The Rust version uses a more complicated tree-flipping
+#    strategy to avoid using extra storage.
 # 2. This version isn't incremental. The Rust version provides incremental
 #    encoders and decoders, which accept small reads and writes from the
 #    caller, and that requires more bookkeeping.
@@ -15,11 +15,13 @@
 #
 # Some more specific details about how each part of this implementation works:
 #
-# *bao_decode*, *bao_slice*, and *bao_decode_slice* are recursive streaming
-# implementations. Recursion is easy here because the length header at the
-# start of the encoding tells us all we need to know about the layout of the
-# tree. The pre-order layout means that neither of the decode functions needs
-# to seek (though bao_slice does, to skip the parts that aren't in the slice).
+# *bao_decode*, *bao_slice*, and *bao_decode_slice* are streaming
+# implementations that walk the tree depth-first, with an explicit stack of
+# subtrees rather than recursion. That's easy here because the length header at
+# the start of the encoding tells us all we need to know about the layout of
+# the tree. The pre-order layout means that neither of the decode functions
+# needs to seek (though bao_slice does, to skip the parts that aren't in the
+# slice).
 #
 # *bao_hash* (identical to the BLAKE3 hash function) is an iterative streaming
 # implementation, which is closer to an incremental implementation than the
@@ -35,12 +37,32 @@
 # that we don't need to remember the size of each subtree; just the hash is
 # enough.
 #
-# *bao_encode* is a recursive implementation, but as noted above, it's not
-# streaming. Instead, to keep things simple, it buffers the entire input and
-# output in memory. The Rust implementation uses a more complicated
-# tree-flipping strategy to avoid hogging memory like this, where it writes the
-# output tree first in a post-order layout, and then does a second pass
-# back-to-front to flip it in place to pre-order.
+# *bao_encode* walks the tree with an explicit stack too, but as noted above,
+# it's not streaming. Instead, to keep things simple, it takes the entire input
+# in memory (though the command line maps the input file rather than reading
+# it), and it makes two passes over the tree. The first computes all the
+# chaining values and keeps the parent nodes, and the second writes the parent
+# nodes and chunks to the output in pre-order. The Rust implementation uses a
+# more complicated tree-flipping strategy to avoid holding on to the parent
+# nodes like this, where it writes the output tree first in a post-order
+# layout, and then does a second pass back-to-front to flip it in place to
+# pre-order.
+#
+# *compress* is the pure Python compression function below, but if a libblake3
+# build that exports blake3_compress_in_place can be found, the compression
+# function is delegated to its runtime-dispatched SSE2/SSE4.1/AVX2/AVX-512
+# kernels through ctypes. That function is internal to the C library (it's
+# declared in blake3_impl.h, not blake3.h), so packaged builds generally don't
+# export it, and this needs a build with all symbols visible, pointed to by
+# BAO_LIBBLAKE3 if it isn't on the library path. Failing that, if Numba is
+# installed, the compression function is JIT-compiled to native code instead.
+# Runs of full chunks, which don't depend on each other, are hashed together by
+# *chunk_chaining_values*: in parallel threads with Numba, or with NumPy alone,
+# as lanes of uint32 arrays. If the blake3 package is installed, *bao_hash*
+# hands the whole input to it instead, since the hash is plain BLAKE3. (Its API
+# only exposes the root hash, not the non-root chunk and parent chaining values
+# that the other functions need.) Set BAO_PURE_PYTHON=1 in the environment to
+# force the pure Python code, e.g. when generating test vectors.
 
 __doc__ = """\
 Usage: bao.py hash [<inputs>...]
@@ -51,8 +73,39 @@ Usage: bao.py hash [<inputs>...]
 """
 
 import binascii
+import ctypes
+import ctypes.util
 import hmac
+import io
+import logging
+import mmap
+import operator
+import os
+import struct
 import sys
+import threading
+
+# With BAO_PURE_PYTHON set, none of the optional accelerators get imported, so
+# startup doesn't pay for importing them either.
+if os.environ.get("BAO_PURE_PYTHON"):
+    np = numba = blake3 = None
+else:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    try:
+        import numba
+    except ImportError:
+        numba = None
+
+    try:
+        import blake3
+    except ImportError:
+        blake3 = None
+
+_logger = logging.getLogger(__name__)
 
 # the BLAKE3 initialization constants
 IV = [
@@ -86,6 +139,11 @@ WORD_BITS = 32
 WORD_BYTES = 4
 WORD_MAX = 2**WORD_BITS - 1
 HEADER_SIZE = 8
+# bao_hash reads and hashes input in batches of this many bytes
+READ_SIZE = 64 * CHUNK_SIZE
+# bao_encode hashes full chunks in windows of this many bytes, so that the
+# batch backends' working copies of the input stay small however big it is
+ENCODE_WINDOW_SIZE = 16 * READ_SIZE
 
 # domain flags
 CHUNK_START = 1 << 0
@@ -100,82 +158,443 @@ IS_ROOT = object()
 NOT_ROOT = object()
 
 
-def wrapping_add(a, b):
-    return (a + b) & WORD_MAX
-
-
-def rotate_right(x, n):
-    return (x >> n | x << (WORD_BITS - n)) & WORD_MAX
+# The pure Python compression function works on the state as four rows of four
+# words: (s0..s3), (s4..s7), (s8..s11), and (s12..s15). Each row is packed into
+# a single int with one 32-bit word per 64-bit lane, the same layout the SIMD
+# implementations use with vector registers. The 32 zero bits above each word
+# catch the carries from additions and the bits shifted out by rotations, and
+# masking with LANE_MASK clears them again, so every int operation acts on four
+# words at once.
+LANE_BITS = 64
+LANE_MASK = sum(WORD_MAX << (LANE_BITS * lane) for lane in range(4))
+ROW_MASK = 2 ** (4 * LANE_BITS) - 1
 
 
-# The BLAKE3 G function.
-def g(state, a, b, c, d, x, y):
-    state[a] = wrapping_add(state[a], wrapping_add(state[b], x))
-    state[d] = rotate_right(state[d] ^ state[a], 16)
-    state[c] = wrapping_add(state[c], state[d])
-    state[b] = rotate_right(state[b] ^ state[c], 12)
-    state[a] = wrapping_add(state[a], wrapping_add(state[b], y))
-    state[d] = rotate_right(state[d] ^ state[a], 8)
-    state[c] = wrapping_add(state[c], state[d])
-    state[b] = rotate_right(state[b] ^ state[c], 7)
+# A packed row from its little-endian bytes.
+def row(buf):
+    return int.from_bytes(buf, "little")
 
 
-# the BLAKE3 round function
-def round(state, msg_words, schedule):
-    # Mix the columns.
-    g(state, 0, 4, 8, 12, msg_words[schedule[0]], msg_words[schedule[1]])
-    g(state, 1, 5, 9, 13, msg_words[schedule[2]], msg_words[schedule[3]])
-    g(state, 2, 6, 10, 14, msg_words[schedule[4]], msg_words[schedule[5]])
-    g(state, 3, 7, 11, 15, msg_words[schedule[6]], msg_words[schedule[7]])
-    # Mix the rows.
-    g(state, 0, 5, 10, 15, msg_words[schedule[8]], msg_words[schedule[9]])
-    g(state, 1, 6, 11, 12, msg_words[schedule[10]], msg_words[schedule[11]])
-    g(state, 2, 7, 8, 13, msg_words[schedule[12]], msg_words[schedule[13]])
-    g(state, 3, 4, 9, 14, msg_words[schedule[14]], msg_words[schedule[15]])
-
-
-def words_from_bytes(buf):
-    words = [0] * (len(buf) // WORD_BYTES)
-    for word_i in range(len(words)):
-        words[word_i] = int.from_bytes(
-            buf[word_i * WORD_BYTES : (word_i + 1) * WORD_BYTES], "little"
-        )
-    return words
+# The message schedule as one itemgetter per round, which permutes all sixteen
+# message words of a block in a single call, in the order that compress_rows
+# packs them into rows.
+MSG_ROW_ORDER = [0, 2, 4, 6, 1, 3, 5, 7, 8, 10, 12, 14, 9, 11, 13, 15]
+MSG_PERMUTERS = [
+    operator.itemgetter(*[schedule[i] for i in MSG_ROW_ORDER])
+    for schedule in MSG_SCHEDULE
+]
 
+# Little-endian conversions from a 64-byte block to its 16 words, and from 8
+# words to a 32-byte chaining value, each done in one struct call.
+_BLOCK_UNPACK = struct.Struct("<16I").unpack_from
+_CV_PACK = struct.Struct("<8I").pack
+# Conversions between words and packed rows. A row's little-endian bytes are
+# its words, each as a 64-bit integer.
+_ROW_PACK = struct.Struct("<4Q").pack
+_ROWS_PACK = struct.Struct("<16Q").pack
+_ROWS_UNPACK = struct.Struct("<8Q").unpack
 
-def bytes_from_words(words):
-    buf = bytearray(len(words) * WORD_BYTES)
-    for word_i in range(len(words)):
-        buf[WORD_BYTES * word_i : WORD_BYTES * (word_i + 1)] = words[word_i].to_bytes(
-            WORD_BYTES, "little"
-        )
-    return buf
+# The constant rows of the initial state: the first four IV words, and the
+# block length and flags of a full block with no flags set.
+IV_ROW = row(_ROW_PACK(IV[0], IV[1], IV[2], IV[3]))
+FULL_BLOCK_ROW = BLOCK_SIZE << (2 * LANE_BITS)
 
 
 # The truncated BLAKE3 compression function.
 def compress(cv, block, block_len, offset, flags):
-    block_words = words_from_bytes(block)
-    state = [
-        cv[0],
-        cv[1],
-        cv[2],
-        cv[3],
-        cv[4],
-        cv[5],
-        cv[6],
-        cv[7],
-        IV[0],
-        IV[1],
-        IV[2],
-        IV[3],
-        offset & WORD_MAX,
-        (offset >> WORD_BITS) & WORD_MAX,
-        block_len,
-        flags,
+    d = row(_ROW_PACK(offset & WORD_MAX, offset >> WORD_BITS, block_len, flags))
+    return compress_rows(cv, block, d)
+
+
+# compress() for a full block with no flags set, which is every block of a
+# chunk but the first and the last. The last row of the state is then constant
+# apart from the counter, so it's built with two shifts instead of a round trip
+# through bytes.
+def compress_full_block(cv, block, offset):
+    d = offset & WORD_MAX | offset >> WORD_BITS << LANE_BITS | FULL_BLOCK_ROW
+    return compress_rows(cv, block, d)
+
+
+# The rounds and output of the compression function, given the packed last row
+# of the initial state. The G function and the rounds are written out inline
+# rather than as function calls, which would cost 21 calls per block: seven
+# rounds, each with two G calls.
+def compress_rows(cv, block, d):
+    block_words = _BLOCK_UNPACK(block)
+    from_bytes = int.from_bytes
+    mask = LANE_MASK
+    row_mask = ROW_MASK
+    a = from_bytes(_ROW_PACK(cv[0], cv[1], cv[2], cv[3]), "little")
+    b = from_bytes(_ROW_PACK(cv[4], cv[5], cv[6], cv[7]), "little")
+    c = IV_ROW
+    for permute in MSG_PERMUTERS:
+        # This round's message words, permuted by the message schedule and laid
+        # out as four rows: the first and second message words of the four
+        # column G's, then the same for the four diagonal G's.
+        msgs = _ROWS_PACK(*permute(block_words))
+        # Mix the columns.
+        a = (a + b + from_bytes(msgs[0:32], "little")) & mask
+        d ^= a
+        d = (d >> 16 | d << 16) & mask
+        c = (c + d) & mask
+        b ^= c
+        b = (b >> 12 | b << 20) & mask
+        a = (a + b + from_bytes(msgs[32:64], "little")) & mask
+        d ^= a
+        d = (d >> 8 | d << 24) & mask
+        c = (c + d) & mask
+        b ^= c
+        b = (b >> 7 | b << 25) & mask
+        # Rotate the lanes of the last three rows so that the diagonals line up
+        # as columns, e.g. s0, s5, s10, and s15 all land in the first lane.
+        b = (b >> 64 | b << 192) & row_mask
+        c = (c >> 128 | c << 128) & row_mask
+        d = (d >> 192 | d << 64) & row_mask
+        # Mix the diagonals.
+        a = (a + b + from_bytes(msgs[64:96], "little")) & mask
+        d ^= a
+        d = (d >> 16 | d << 16) & mask
+        c = (c + d) & mask
+        b ^= c
+        b = (b >> 12 | b << 20) & mask
+        a = (a + b + from_bytes(msgs[96:128], "little")) & mask
+        d ^= a
+        d = (d >> 8 | d << 24) & mask
+        c = (c + d) & mask
+        b ^= c
+        b = (b >> 7 | b << 25) & mask
+        # Rotate the lanes back.
+        b = (b >> 192 | b << 64) & row_mask
+        c = (c >> 128 | c << 128) & row_mask
+        d = (d >> 64 | d << 192) & row_mask
+    out = (a ^ c).to_bytes(32, "little") + (b ^ d).to_bytes(32, "little")
+    return list(_ROWS_UNPACK(out))
+
+
+# Look up blake3_compress_in_place in libblake3, which is the same truncated
+# compression function as above, dispatched to the best SIMD kernel the CPU
+# supports. It isn't part of the library's public API, so only builds that
+# export every symbol have it. The library is loaded from BAO_LIBBLAKE3 if
+# that's set, and otherwise searched for on the library path. Returns None if
+# the library or the symbol isn't available.
+def load_native_compress():
+    if os.environ.get("BAO_PURE_PYTHON"):
+        return None
+    path = os.environ.get("BAO_LIBBLAKE3")
+    # Failing to load a library that was asked for explicitly is worth a
+    # warning. A packaged libblake3 without the symbol is the common case.
+    level = logging.WARNING if path else logging.INFO
+    if not path:
+        path = ctypes.util.find_library("blake3")
+        if path is None:
+            return None
+    try:
+        native = ctypes.CDLL(path).blake3_compress_in_place
+    except (OSError, AttributeError) as e:
+        _logger.log(level, "not using %s for compress: %s", path, e)
+        return None
+    native.argtypes = [
+        ctypes.c_uint32 * 8,
+        ctypes.c_uint8 * BLOCK_SIZE,
+        ctypes.c_uint8,
+        ctypes.c_uint64,
+        ctypes.c_uint8,
     ]
-    for round_number in range(7):
-        round(state, block_words, MSG_SCHEDULE[round_number])
-    return [state[i] ^ state[i + 8] for i in range(8)]
+    native.restype = None
+    return native
+
+
+_native_compress_in_place = load_native_compress()
+
+
+# The truncated BLAKE3 compression function, as one call into libblake3.
+def native_compress(cv, block, block_len, offset, flags):
+    cv_words = (ctypes.c_uint32 * 8)(*cv)
+    block_bytes = (ctypes.c_uint8 * BLOCK_SIZE).from_buffer_copy(block)
+    _native_compress_in_place(cv_words, block_bytes, block_len, offset, flags)
+    return list(cv_words)
+
+
+def native_compress_full_block(cv, block, offset):
+    cv_words = (ctypes.c_uint32 * 8)(*cv)
+    block_bytes = (ctypes.c_uint8 * BLOCK_SIZE).from_buffer_copy(block)
+    _native_compress_in_place(cv_words, block_bytes, BLOCK_SIZE, offset, 0)
+    return list(cv_words)
+
+
+if np is not None:
+    IV_ARRAY = np.array(IV, dtype=np.uint32)
+    # Below this many chunks, the per-call overhead of NumPy outweighs running
+    # the lanes in parallel, and hashing the chunks one at a time is faster.
+    MIN_NUMPY_LANES = 32
+
+    # The BLAKE3 G function on a state of sixteen words, each a uint32 array
+    # with one lane per block. uint32 arrays wrap around on overflow, so unlike
+    # the pure Python version there's no masking. Every operation makes a new
+    # array, so the arrays that state starts out holding, like the caller's cv
+    # rows, are never written to.
+    def g_many(state, a, b, c, d, x, y):
+        sa, sb, sc, sd = state[a], state[b], state[c], state[d]
+        sa = sa + sb + x
+        sd = sd ^ sa
+        sd = sd >> 16 | sd << 16
+        sc = sc + sd
+        sb = sb ^ sc
+        sb = sb >> 12 | sb << 20
+        sa = sa + sb + y
+        sd = sd ^ sa
+        sd = sd >> 8 | sd << 24
+        sc = sc + sd
+        sb = sb ^ sc
+        sb = sb >> 7 | sb << 25
+        state[a], state[b], state[c], state[d] = sa, sb, sc, sd
+
+    # The truncated BLAKE3 compression function, applied to many blocks at
+    # once. This is the same transposed layout as BLAKE3's SIMD hash_many:
+    # cvs has shape (8, lanes) and block_words has shape (16, lanes), so each
+    # row is one word across all the lanes, and every NumPy operation does the
+    # work of one scalar operation for all of them.
+    def compress_many(cvs, block_words, block_len, offsets, flags):
+        lanes = len(offsets)
+        state = [
+            cvs[0],
+            cvs[1],
+            cvs[2],
+            cvs[3],
+            cvs[4],
+            cvs[5],
+            cvs[6],
+            cvs[7],
+            np.full(lanes, IV[0], dtype=np.uint32),
+            np.full(lanes, IV[1], dtype=np.uint32),
+            np.full(lanes, IV[2], dtype=np.uint32),
+            np.full(lanes, IV[3], dtype=np.uint32),
+            (offsets & WORD_MAX).astype(np.uint32),
+            (offsets >> WORD_BITS).astype(np.uint32),
+            np.full(lanes, block_len, dtype=np.uint32),
+            np.full(lanes, flags, dtype=np.uint32),
+        ]
+        for schedule in MSG_SCHEDULE:
+            m = [block_words[i] for i in schedule]
+            # Mix the columns.
+            g_many(state, 0, 4, 8, 12, m[0], m[1])
+            g_many(state, 1, 5, 9, 13, m[2], m[3])
+            g_many(state, 2, 6, 10, 14, m[4], m[5])
+            g_many(state, 3, 7, 11, 15, m[6], m[7])
+            # Mix the rows.
+            g_many(state, 0, 5, 10, 15, m[8], m[9])
+            g_many(state, 1, 6, 11, 12, m[10], m[11])
+            g_many(state, 2, 7, 8, 13, m[12], m[13])
+            g_many(state, 3, 4, 9, 14, m[14], m[15])
+        return np.array([state[i] ^ state[i + 8] for i in range(8)])
+
+    # Compute the chaining values of consecutive full chunks with NumPy, one
+    # chunk per lane.
+    def numpy_chunk_chaining_values(buf, chunk_index):
+        lanes = len(buf) // CHUNK_SIZE
+        if lanes < MIN_NUMPY_LANES:
+            return chunk_chaining_values_serial(buf, chunk_index)
+        chunk_words = np.frombuffer(buf, dtype="<u4").reshape(lanes, -1)
+        # Transpose to one row per word position, so that the rows of each
+        # block can be handed to compress_many as they are.
+        chunk_words = chunk_words.T.astype(np.uint32)
+        cvs = np.repeat(IV_ARRAY[:, np.newaxis], lanes, axis=1)
+        offsets = chunk_index + np.arange(lanes, dtype=np.uint64)
+        flags = CHUNK_START
+        for block_index in range(CHUNK_SIZE // BLOCK_SIZE):
+            if block_index == CHUNK_SIZE // BLOCK_SIZE - 1:
+                flags |= CHUNK_END
+            block_words = chunk_words[16 * block_index : 16 * (block_index + 1)]
+            cvs = compress_many(cvs, block_words, BLOCK_SIZE, offsets, flags)
+            flags = 0
+        return [cv.astype("<u4").tobytes() for cv in cvs.T]
+
+
+if numba is not None and np is not None:
+    MSG_SCHEDULE_ARRAY = np.array(MSG_SCHEDULE, dtype=np.uint8)
+    NUMBA_WORD_MAX = np.uint64(WORD_MAX)
+    # Kernel argument types for input words, which may be read straight out of
+    # a read-only buffer like bytes or a read-only memory map.
+    READONLY_WORDS = "Array(uint32, 1, 'A', readonly=True)"
+    READONLY_CHUNK_WORDS = "Array(uint32, 2, 'A', readonly=True)"
+
+    # Kernels are compiled on first use rather than at import, which would
+    # otherwise take seconds whether or not they ever get called. njit_cached
+    # declares a kernel with Numba's on-disk cache, and load_numba_kernels
+    # compiles each of them for its signature, in the order they're declared in,
+    # and then stops it from compiling for any other argument types, like an
+    # eagerly compiled kernel would. A cache entry remembers the name of the
+    # module that wrote it and imports that module when loaded, which fails when
+    # this file was cached under one name (e.g. imported as docs.bao_reference)
+    # and is now running under another (e.g. as a script). In that case, every
+    # kernel is compiled again without the cache.
+    NUMBA_KERNELS = []
+    numba_kernels_loaded = False
+    numba_kernels_lock = threading.Lock()
+
+    def njit_cached(signature, **options):
+        def decorate(func):
+            NUMBA_KERNELS.append((func, signature, options))
+            return numba.njit(cache=True, **options)(func)
+
+        return decorate
+
+    def load_numba_kernels():
+        global numba_kernels_loaded
+        if numba_kernels_loaded:
+            return
+        with numba_kernels_lock:
+            if numba_kernels_loaded:
+                return
+            try:
+                for func, signature, options in NUMBA_KERNELS:
+                    compile_numba_kernel(globals()[func.__name__], signature)
+            except ImportError:
+                for func, signature, options in NUMBA_KERNELS:
+                    kernel = numba.njit(**options)(func)
+                    compile_numba_kernel(kernel, signature)
+                    globals()[func.__name__] = kernel
+            numba_kernels_loaded = True
+
+    def compile_numba_kernel(kernel, signature):
+        kernel.compile(signature)
+        kernel.disable_compile()
+
+    # The BLAKE3 G function on four state words held in uint64 locals. Numba
+    # inlines this, so the rotations compile down to single instructions.
+    @numba.njit(inline="always")
+    def g_njit(a, b, c, d, x, y):
+        a = (a + b + x) & NUMBA_WORD_MAX
+        d ^= a
+        d = (d >> np.uint64(16) | d << np.uint64(16)) & NUMBA_WORD_MAX
+        c = (c + d) & NUMBA_WORD_MAX
+        b ^= c
+        b = (b >> np.uint64(12) | b << np.uint64(20)) & NUMBA_WORD_MAX
+        a = (a + b + y) & NUMBA_WORD_MAX
+        d ^= a
+        d = (d >> np.uint64(8) | d << np.uint64(24)) & NUMBA_WORD_MAX
+        c = (c + d) & NUMBA_WORD_MAX
+        b ^= c
+        b = (b >> np.uint64(7) | b << np.uint64(25)) & NUMBA_WORD_MAX
+        return a, b, c, d
+
+    # The truncated BLAKE3 compression function, compiled. The state lives in
+    # sixteen scalar locals rather than an array, so LLVM can keep it all in
+    # registers across the seven rounds.
+    @njit_cached(f"uint32[:](uint32[:], {READONLY_WORDS}, uint32, uint64, uint32)")
+    def compress_njit(cv, block_words, block_len, offset, flags):
+        s0 = np.uint64(cv[0])
+        s1 = np.uint64(cv[1])
+        s2 = np.uint64(cv[2])
+        s3 = np.uint64(cv[3])
+        s4 = np.uint64(cv[4])
+        s5 = np.uint64(cv[5])
+        s6 = np.uint64(cv[6])
+        s7 = np.uint64(cv[7])
+        s8 = np.uint64(IV_ARRAY[0])
+        s9 = np.uint64(IV_ARRAY[1])
+        s10 = np.uint64(IV_ARRAY[2])
+        s11 = np.uint64(IV_ARRAY[3])
+        s12 = offset & NUMBA_WORD_MAX
+        s13 = (offset >> np.uint64(WORD_BITS)) & NUMBA_WORD_MAX
+        s14 = np.uint64(block_len)
+        s15 = np.uint64(flags)
+        m = block_words.astype(np.uint64)
+        for round_number in range(7):
+            schedule = MSG_SCHEDULE_ARRAY[round_number]
+            # Mix the columns.
+            s0, s4, s8, s12 = g_njit(s0, s4, s8, s12, m[schedule[0]], m[schedule[1]])
+            s1, s5, s9, s13 = g_njit(s1, s5, s9, s13, m[schedule[2]], m[schedule[3]])
+            s2, s6, s10, s14 = g_njit(s2, s6, s10, s14, m[schedule[4]], m[schedule[5]])
+            s3, s7, s11, s15 = g_njit(s3, s7, s11, s15, m[schedule[6]], m[schedule[7]])
+            # Mix the rows.
+            s0, s5, s10, s15 = g_njit(s0, s5, s10, s15, m[schedule[8]], m[schedule[9]])
+            s1, s6, s11, s12 = g_njit(
+                s1, s6, s11, s12, m[schedule[10]], m[schedule[11]]
+            )
+            s2, s7, s8, s13 = g_njit(s2, s7, s8, s13, m[schedule[12]], m[schedule[13]])
+            s3, s4, s9, s14 = g_njit(s3, s4, s9, s14, m[schedule[14]], m[schedule[15]])
+        out = np.empty(8, dtype=np.uint32)
+        out[0] = s0 ^ s8
+        out[1] = s1 ^ s9
+        out[2] = s2 ^ s10
+        out[3] = s3 ^ s11
+        out[4] = s4 ^ s12
+        out[5] = s5 ^ s13
+        out[6] = s6 ^ s14
+        out[7] = s7 ^ s15
+        return out
+
+    # compress_njit for a full block with no flags set. With the block length
+    # and flags constant, LLVM can fold them into the state setup.
+    @njit_cached(f"uint32[:](uint32[:], {READONLY_WORDS}, uint64)")
+    def compress_full_block_njit(cv, block_words, offset):
+        return compress_njit(cv, block_words, BLOCK_SIZE, offset, 0)
+
+    # The truncated BLAKE3 compression function, marshalled through Numba.
+    def numba_compress(cv, block, block_len, offset, flags):
+        load_numba_kernels()
+        cv_words = np.array(cv, dtype=np.uint32)
+        block_words = np.frombuffer(block, dtype="<u4").astype(np.uint32)
+        return compress_njit(cv_words, block_words, block_len, offset, flags).tolist()
+
+    def numba_compress_full_block(cv, block, offset):
+        load_numba_kernels()
+        cv_words = np.array(cv, dtype=np.uint32)
+        block_words = np.frombuffer(block, dtype="<u4").astype(np.uint32)
+        return compress_full_block_njit(cv_words, block_words, offset).tolist()
+
+    # Compute the chaining values of a run of full chunks, one chunk per thread.
+    # Row i of chunk_words holds the words of chunk start_index + i, and flags
+    # are added to the last block of every chunk.
+    @njit_cached(f"uint32[:, :]({READONLY_CHUNK_WORDS}, uint64, uint32)", parallel=True)
+    def chunk_cvs_batch(chunk_words, start_index, flags):
+        cvs = np.empty((chunk_words.shape[0], 8), dtype=np.uint32)
+        for i in numba.prange(chunk_words.shape[0]):
+            cv = IV_ARRAY.copy()
+            offset = start_index + np.uint64(i)
+            last_block = CHUNK_SIZE // BLOCK_SIZE - 1
+            for block_index in range(CHUNK_SIZE // BLOCK_SIZE):
+                block_words = chunk_words[i, block_index * 16 : (block_index + 1) * 16]
+                if block_index == 0:
+                    cv = compress_njit(
+                        cv, block_words, BLOCK_SIZE, offset, np.uint32(CHUNK_START)
+                    )
+                elif block_index == last_block:
+                    block_flags = np.uint32(CHUNK_END) | flags
+                    cv = compress_njit(cv, block_words, BLOCK_SIZE, offset, block_flags)
+                else:
+                    cv = compress_full_block_njit(cv, block_words, offset)
+            cvs[i] = cv
+        return cvs
+
+    # Numba's fallback workqueue threading layer, used when neither TBB nor
+    # OpenMP is available, aborts the process if parallel kernels are launched
+    # from two Python threads at once. chunk_cvs_batch already keeps every core
+    # busy, so callers take turns.
+    numba_batch_lock = threading.Lock()
+
+    # Compute the chaining values of consecutive full chunks with Numba, all
+    # chunks in parallel.
+    def numba_chunk_chaining_values(buf, chunk_index):
+        load_numba_kernels()
+        # On little-endian machines, this is a view of buf rather than a copy.
+        chunk_words = np.frombuffer(buf, dtype="<u4").astype(np.uint32, copy=False)
+        chunk_words = chunk_words.reshape(-1, CHUNK_SIZE // WORD_BYTES)
+        with numba_batch_lock:
+            cvs = chunk_cvs_batch(chunk_words, chunk_index, 0)
+        return [cv.astype("<u4").tobytes() for cv in cvs]
+
+else:
+    numba = None
+
+
+if _native_compress_in_place is not None:
+    compress = native_compress
+    compress_full_block = native_compress_full_block
+elif numba is not None:
+    compress = numba_compress
+    compress_full_block = numba_compress_full_block
 
 
 # Compute a BLAKE3 chunk chaining value.
@@ -185,17 +604,22 @@ def chunk_chaining_value(chunk_bytes, chunk_index, finalization):
     flags = CHUNK_START
     while len(chunk_bytes) - i > BLOCK_SIZE:
         block = chunk_bytes[i : i + BLOCK_SIZE]
-        cv = compress(cv, block, BLOCK_SIZE, chunk_index, flags)
-        flags = 0
+        if flags:
+            cv = compress(cv, block, BLOCK_SIZE, chunk_index, flags)
+            flags = 0
+        else:
+            cv = compress_full_block(cv, block, chunk_index)
         i += BLOCK_SIZE
     flags |= CHUNK_END
     if finalization is IS_ROOT:
         flags |= ROOT
-    block = chunk_bytes[i:]
-    block_len = len(block)
-    block += b"\0" * (BLOCK_SIZE - block_len)
+    # Zero-pad the last block. The padded block is local to this call, so that
+    # threads hashing at the same time can't overwrite each other's.
+    block_len = len(chunk_bytes) - i
+    block = bytearray(BLOCK_SIZE)
+    block[:block_len] = chunk_bytes[i:]
     cv = compress(cv, block, block_len, chunk_index, flags)
-    return bytes_from_words(cv)
+    return _CV_PACK(*cv)
 
 
 # Compute a BLAKE3 parent node chaining value.
@@ -205,24 +629,55 @@ def parent_chaining_value(parent_bytes, finalization):
     if finalization is IS_ROOT:
         flags |= ROOT
     cv = compress(cv, parent_bytes, BLOCK_SIZE, 0, flags)
-    return bytes_from_words(cv)
+    return _CV_PACK(*cv)
+
+
+# Compute the chaining values of consecutive full chunks, none of them the
+# root, where the first chunk has index chunk_index. The chunks are independent
+# of each other, so this is the place to hash many of them at once.
+def chunk_chaining_values_serial(buf, chunk_index):
+    return [
+        chunk_chaining_value(buf[i : i + CHUNK_SIZE], chunk_index + j, NOT_ROOT)
+        for j, i in enumerate(range(0, len(buf), CHUNK_SIZE))
+    ]
 
 
-# Verify a chunk chaining value with a constant-time comparison.
+chunk_chaining_values = chunk_chaining_values_serial
+if numba is not None:
+    chunk_chaining_values = numba_chunk_chaining_values
+elif np is not None and _native_compress_in_place is None:
+    chunk_chaining_values = numpy_chunk_chaining_values
+
+
+# Bound once here, since verification calls it for every chunk and parent.
+_compare_digest = hmac.compare_digest
+
+
+# Verify a chunk chaining value with a constant-time comparison. This raises
+# rather than asserting, so that running under python -O doesn't skip it.
 def verify_chunk(expected_cv, chunk_bytes, chunk_index, finalization):
     found_cv = chunk_chaining_value(chunk_bytes, chunk_index, finalization)
-    assert hmac.compare_digest(expected_cv, found_cv), "hash mismatch"
+    if not _compare_digest(expected_cv, found_cv):
+        raise ValueError("hash mismatch")
 
 
 # Verify a parent node chaining value with a constant-time comparison.
 def verify_parent(expected_cv, parent_bytes, finalization):
     found_cv = parent_chaining_value(parent_bytes, finalization)
-    assert hmac.compare_digest(expected_cv, found_cv), "hash mismatch"
+    if not _compare_digest(expected_cv, found_cv):
+        raise ValueError("hash mismatch")
 
 
+# Read exactly n bytes. Buffered streams return them all from one read() call,
+# as a single allocation with no zero-fill. Streams that return short reads fall
+# back to filling the rest of a buffer with readinto().
 def read_exact(stream, n):
-    out = bytearray(n)
-    mv = memoryview(out)
+    out = stream.read(n) or b""
+    partial = len(out)
+    if partial == n:
+        return out
+    out = bytearray(out) + bytes(n - partial)
+    mv = memoryview(out)[partial:]
     while mv:
         n = stream.readinto(mv)
         if n == 0:
@@ -240,46 +695,100 @@ def decode_len(len_bytes):
 
 
 # Left subtrees contain the largest possible power of two chunks, with at least
-# one byte left for the right subtree.
+# one byte left for the right subtree. The tree walks below call this for every
+# parent node, so they bind it to a local _left_len first.
 def left_len(parent_len):
     available_chunks = (parent_len - 1) // CHUNK_SIZE
-    power_of_two_chunks = 2 ** (available_chunks.bit_length() - 1)
-    return CHUNK_SIZE * power_of_two_chunks
+    return CHUNK_SIZE << (available_chunks.bit_length() - 1)
 
 
 def bao_encode(buf, *, outboard=False):
-    chunk_index = 0
-
-    def encode_recurse(buf, finalization):
-        nonlocal chunk_index
-        if len(buf) <= CHUNK_SIZE:
-            chunk_cv = chunk_chaining_value(buf, chunk_index, finalization)
-            chunk_encoded = b"" if outboard else buf
-            chunk_index += 1
-            return chunk_encoded, chunk_cv
-        llen = left_len(len(buf))
-        # Interior nodes have no len suffix.
-        left_encoded, left_cv = encode_recurse(buf[:llen], NOT_ROOT)
-        right_encoded, right_cv = encode_recurse(buf[llen:], NOT_ROOT)
-        node = left_cv + right_cv
-        encoded = node + left_encoded + right_encoded
-        return encoded, parent_chaining_value(node, finalization)
-
-    # Only this topmost call sets a non-None finalization.
-    encoded, hash_ = encode_recurse(buf, IS_ROOT)
-    # The final output prefixes the encoded length.
-    output = encode_len(len(buf)) + encoded
-    return output, hash_
+    output = io.BytesIO()
+    hash_ = bao_encode_to_stream(buf, output, outboard=outboard)
+    return output.getvalue(), hash_
+
+
+def bao_encode_to_stream(buf, output_stream, *, outboard=False):
+    _left_len = left_len
+    # Chunks are sliced out of a memoryview, so they share memory with the
+    # input (which may be a memory-mapped file) rather than copying it.
+    buf = memoryview(buf)
+    # Hash all the full non-root chunks up front, a window at a time. That
+    # leaves at most a short final chunk, or a lone root chunk, for the tree
+    # walk.
+    chunk_cvs = []
+    if len(buf) > CHUNK_SIZE:
+        full_len = len(buf) - len(buf) % CHUNK_SIZE
+        for start in range(0, full_len, ENCODE_WINDOW_SIZE):
+            window = buf[start : min(start + ENCODE_WINDOW_SIZE, full_len)]
+            chunk_cvs.extend(chunk_chaining_values(window, start // CHUNK_SIZE))
+
+    # The first pass computes the parent nodes. Subtrees are popped off the
+    # stack in pre-order, which is the order of the output, so each parent node
+    # reserves its slot in nodes before its children are visited. Its entry
+    # stays on the stack underneath them, and once it comes back around, the
+    # children's chaining values are on top of cvs. Only the root entry sets a
+    # non-None finalization.
+    nodes = []
+    stack = [(0, len(buf), IS_ROOT, None)]
+    cvs = []
+    while stack:
+        start, length, finalization, node_slot = stack.pop()
+        if node_slot is not None:
+            right_cv = cvs.pop()
+            left_cv = cvs.pop()
+            # Interior nodes have no len suffix.
+            node = left_cv + right_cv
+            nodes[node_slot] = node
+            cvs.append(parent_chaining_value(node, finalization))
+        elif length <= CHUNK_SIZE:
+            chunk_index = start // CHUNK_SIZE
+            if chunk_index < len(chunk_cvs):
+                cvs.append(chunk_cvs[chunk_index])
+            else:
+                chunk = buf[start : start + length]
+                cvs.append(chunk_chaining_value(chunk, chunk_index, finalization))
+        else:
+            llen = _left_len(length)
+            nodes.append(None)
+            stack.append((start, length, finalization, len(nodes) - 1))
+            stack.append((start + llen, length - llen, NOT_ROOT, None))
+            stack.append((start, llen, NOT_ROOT, None))
+
+    # The second pass writes the output, which starts with the encoded length.
+    # An outboard encoding is just the parent nodes, already in pre-order.
+    # Otherwise, walk the tree again to interleave them with the chunks.
+    output_stream.write(encode_len(len(buf)))
+    if outboard:
+        for node in nodes:
+            output_stream.write(node)
+        return cvs[0]
+    nodes = iter(nodes)
+    stack = [(0, len(buf))]
+    while stack:
+        start, length = stack.pop()
+        if length <= CHUNK_SIZE:
+            output_stream.write(buf[start : start + length])
+        else:
+            output_stream.write(next(nodes))
+            llen = _left_len(length)
+            stack.append((start + llen, length - llen))
+            stack.append((start, llen))
+    return cvs[0]
 
 
 def bao_decode(input_stream, output_stream, hash_, *, outboard_stream=None):
     tree_stream = outboard_stream or input_stream
+    _left_len = left_len
     chunk_index = 0
-
-    def decode_recurse(subtree_cv, content_len, finalization):
-        nonlocal chunk_index
-        if content_len <= CHUNK_SIZE:
-            chunk = read_exact(input_stream, content_len)
+    content_len = decode_len(read_exact(tree_stream, HEADER_SIZE))
+    # Right subtrees go on the stack underneath left subtrees, so that subtrees
+    # come off it in the same pre-order that they're encoded in.
+    stack = [(hash_, content_len, IS_ROOT)]
+    while stack:
+        subtree_cv, subtree_len, finalization = stack.pop()
+        if subtree_len <= CHUNK_SIZE:
+            chunk = read_exact(input_stream, subtree_len)
             verify_chunk(subtree_cv, chunk, chunk_index, finalization)
             chunk_index += 1
             output_stream.write(chunk)
@@ -287,39 +796,64 @@ def bao_decode(input_stream, output_stream, hash_, *, outboard_stream=None):
             parent = read_exact(tree_stream, PARENT_SIZE)
             verify_parent(subtree_cv, parent, finalization)
             left_cv, right_cv = parent[:HASH_SIZE], parent[HASH_SIZE:]
-            llen = left_len(content_len)
-            decode_recurse(left_cv, llen, NOT_ROOT)
-            decode_recurse(right_cv, content_len - llen, NOT_ROOT)
-
-    content_len = decode_len(read_exact(tree_stream, HEADER_SIZE))
-    decode_recurse(hash_, content_len, IS_ROOT)
+            llen = _left_len(subtree_len)
+            stack.append((right_cv, subtree_len - llen, NOT_ROOT))
+            stack.append((left_cv, llen, NOT_ROOT))
 
 
 # This is identical to the BLAKE3 hash function.
 def bao_hash(input_stream):
-    buf = b""
+    # Input accumulates in buf, and everything before cursor has been hashed.
+    # Chunks are handed out as memoryview slices, and buf is only compacted
+    # once per READ_SIZE, so no input byte gets copied more than a few times.
+    buf = bytearray()
+    cursor = 0
     chunks = 0
     subtrees = []
     while True:
-        read = input_stream.read(CHUNK_SIZE)
+        read = input_stream.read(READ_SIZE)
         if not read:
+            last_chunk = memoryview(buf)[cursor:]
             if chunks == 0:
-                return chunk_chaining_value(buf, chunks, IS_ROOT)
-            new_subtree = chunk_chaining_value(buf, chunks, NOT_ROOT)
+                return chunk_chaining_value(last_chunk, chunks, IS_ROOT)
+            new_subtree = chunk_chaining_value(last_chunk, chunks, NOT_ROOT)
             while len(subtrees) > 1:
                 parent = subtrees.pop() + new_subtree
                 new_subtree = parent_chaining_value(parent, NOT_ROOT)
             return parent_chaining_value(subtrees[0] + new_subtree, IS_ROOT)
-        if len(buf) >= CHUNK_SIZE:
-            new_subtree = chunk_chaining_value(buf[:CHUNK_SIZE], chunks, NOT_ROOT)
+        buf.extend(read)
+        # Hash every full chunk in the buffer except the last chunk, which
+        # might turn out to be the root.
+        batch_len = (len(buf) - cursor - 1) // CHUNK_SIZE * CHUNK_SIZE
+        batch = memoryview(buf)[cursor : cursor + batch_len]
+        for new_subtree in chunk_chaining_values(batch, chunks):
             chunks += 1
             total_after_merging = bin(chunks).count("1")
             while len(subtrees) + 1 > total_after_merging:
                 parent = subtrees.pop() + new_subtree
                 new_subtree = parent_chaining_value(parent, NOT_ROOT)
             subtrees.append(new_subtree)
-            buf = buf[CHUNK_SIZE:]
-        buf = buf + read
+        # buf can't be resized while a memoryview of it is alive.
+        batch.release()
+        cursor += batch_len
+        if cursor >= READ_SIZE:
+            del buf[:cursor]
+            cursor = 0
+
+
+# bao_hash through the blake3 package, which hashes with the SIMD kernels and
+# threads of the Rust implementation.
+def blake3_hash(input_stream):
+    hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    while True:
+        read = input_stream.read(READ_SIZE)
+        if not read:
+            return hasher.digest()
+        hasher.update(read)
+
+
+if blake3 is not None:
+    bao_hash = blake3_hash
 
 
 def count_chunks(content_len):
@@ -348,7 +882,10 @@ def bao_slice(
     if slice_start >= content_len:
         slice_start = content_len - 1 if content_len > 0 else 0
 
-    def slice_recurse(subtree_start, subtree_len):
+    _left_len = left_len
+    stack = [(0, content_len)]
+    while stack:
+        subtree_start, subtree_len = stack.pop()
         subtree_end = subtree_start + subtree_len
         if subtree_end <= slice_start:
             parent_nodes_size = encoded_subtree_size(subtree_len, outboard=True)
@@ -362,11 +899,9 @@ def bao_slice(
         else:
             parent = read_exact(tree_stream, PARENT_SIZE)
             output_stream.write(parent)
-            llen = left_len(subtree_len)
-            slice_recurse(subtree_start, llen)
-            slice_recurse(subtree_start + llen, subtree_len - llen)
-
-    slice_recurse(0, content_len)
+            llen = _left_len(subtree_len)
+            stack.append((subtree_start + llen, subtree_len - llen))
+            stack.append((subtree_start, llen))
 
 
 def bao_decode_slice(input_stream, output_stream, hash_, slice_start, slice_len):
@@ -383,7 +918,10 @@ def bao_decode_slice(input_stream, output_stream, hash_, slice_start, slice_len)
         slice_start = content_len - 1 if content_len > 0 else 0
         skip_output = True
 
-    def decode_slice_recurse(subtree_start, subtree_len, subtree_cv, finalization):
+    _left_len = left_len
+    stack = [(0, content_len, hash_, IS_ROOT)]
+    while stack:
+        subtree_start, subtree_len, subtree_cv, finalization = stack.pop()
         subtree_end = subtree_start + subtree_len
         if subtree_end <= slice_start and content_len > 0:
             pass
@@ -401,13 +939,9 @@ def bao_decode_slice(input_stream, output_stream, hash_, slice_start, slice_len)
             parent = read_exact(input_stream, PARENT_SIZE)
             verify_parent(subtree_cv, parent, finalization)
             left_cv, right_cv = parent[:HASH_SIZE], parent[HASH_SIZE:]
-            llen = left_len(subtree_len)
-            decode_slice_recurse(subtree_start, llen, left_cv, NOT_ROOT)
-            decode_slice_recurse(
-                subtree_start + llen, subtree_len - llen, right_cv, NOT_ROOT
-            )
-
-    decode_slice_recurse(0, content_len, hash_, IS_ROOT)
+            llen = _left_len(subtree_len)
+            stack.append((subtree_start + llen, subtree_len - llen, right_cv, NOT_ROOT))
+            stack.append((subtree_start, llen, left_cv, NOT_ROOT))
 
 
 def open_input(maybe_path):
@@ -416,6 +950,15 @@ def open_input(maybe_path):
     return open(maybe_path, "rb")
 
 
+# Map an input file into memory rather than reading all of it into a bytes
+# object. Inputs that can't be mapped, like pipes and empty files, are read.
+def map_input(in_stream):
+    try:
+        return mmap.mmap(in_stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return in_stream.read()
+
+
 def open_output(maybe_path):
     if maybe_path is None or maybe_path == "-":
         return sys.stdout.buffer
@@ -437,8 +980,7 @@ def main():
         if args["--outboard"] is not None:
             outboard = True
             out_stream = open_output(args["--outboard"])
-        encoded, _ = bao_encode(in_stream.read(), outboard=outboard)
-        out_stream.write(encoded)
+        bao_encode_to_stream(map_input(in_stream), out_stream, outboard=outboard)
     elif args["decode"]:
         hash_ = binascii.unhexlify(args["<hash>"])
         outboard_stream = None